@@ -1,26 +1,38 @@
 """
-Aplicação Flask para análise de exames médicos com IA (Gemini).
+Aplicação Quart (ASGI) para análise de exames médicos com IA (Gemini).
 Permite upload de imagens de exames e gera laudos comparativos.
 """
 
 import os
 import sys
+import asyncio
+import json
 import uuid
 import base64
+import argparse
+import tempfile
+import contextlib
 from pathlib import Path
-from flask import Flask, render_template, request, jsonify, redirect, url_for, flash
+from quart import Quart, render_template, request, jsonify, redirect, url_for, flash
+from werkzeug.exceptions import RequestEntityTooLarge
 from werkzeug.utils import secure_filename
 from dotenv import load_dotenv
 
-from core.analyzer import analyze_exam
+from core.analyzer import analyze_exam_async
+from core.imaging import describe_pil_build
+from core.reference_images import open_http_session, close_http_session, warm_reference_cache
 
 load_dotenv()
 
-app = Flask(__name__)
+app = Quart(__name__)
 app.secret_key = os.environ.get("FLASK_SECRET_KEY", "dev-secret-key-change-in-prod")
 
 UPLOAD_FOLDER = Path("/tmp/uploads")
 UPLOAD_FOLDER.mkdir(exist_ok=True)
+# Uploads grandes que o parser multipart despeja em arquivo temporário vão para o disco
+# em /tmp/uploads, não para a RAM (hosts com pouca memória, como funções do Vercel)
+tempfile.tempdir = str(UPLOAD_FOLDER)
+UPLOAD_BUFFER_SIZE = 1024 * 1024  # 1 MiB por write() ao salvar o upload
 ALLOWED_EXTENSIONS = {"png", "jpg", "jpeg", "webp", "gif", "dcm"}
 MAX_CONTENT_LENGTH = 20 * 1024 * 1024  # 20MB
 
@@ -28,10 +40,28 @@ app.config["UPLOAD_FOLDER"] = str(UPLOAD_FOLDER)
 app.config["MAX_CONTENT_LENGTH"] = MAX_CONTENT_LENGTH
 
 
+@app.before_serving
+async def startup():
+    print(f"[PIL] {describe_pil_build()}")
+    await open_http_session()
+    # Aquece o cache de referências sem atrasar o início do servidor
+    app.add_background_task(warm_reference_cache)
+
+
+@app.after_serving
+async def shutdown():
+    await close_http_session()
+
+
 def allowed_file(filename: str) -> bool:
     return "." in filename and filename.rsplit(".", 1)[1].lower() in ALLOWED_EXTENSIONS
 
 
+def read_image_b64(filepath: Path) -> str:
+    """Lê o upload salvo como base64 para exibir no resultado (bloqueante: rodar em thread)."""
+    return base64.b64encode(filepath.read_bytes()).decode("utf-8")
+
+
 def get_api_key() -> str:
     """Obtém a chave da API do Gemini."""
     return os.environ.get("GEMINI_API_KEY", "")
@@ -43,56 +73,59 @@ def get_model_name() -> str:
 
 
 @app.route("/")
-def index():
-    return render_template("index.html")
+async def index():
+    return await render_template("index.html")
 
 
 @app.route("/analyze", methods=["POST"])
-def analyze():
+async def analyze():
     """Endpoint para receber e analisar o exame médico."""
     api_key = get_api_key()
     if not api_key:
-        flash("Erro: GEMINI_API_KEY não configurada. Adicione a variável de ambiente no painel do Vercel (Settings → Environment Variables).", "error")
+        await flash("Erro: GEMINI_API_KEY não configurada. Adicione a variável de ambiente no painel do Vercel (Settings → Environment Variables).", "error")
         return redirect(url_for("index"))
 
-    if "exam_image" not in request.files:
-        flash("Nenhuma imagem enviada.", "error")
+    files = await request.files
+    form = await request.form
+
+    if "exam_image" not in files:
+        await flash("Nenhuma imagem enviada.", "error")
         return redirect(url_for("index"))
 
-    file = request.files["exam_image"]
+    file = files["exam_image"]
     if file.filename == "":
-        flash("Nenhum arquivo selecionado.", "error")
+        await flash("Nenhum arquivo selecionado.", "error")
         return redirect(url_for("index"))
 
     if not allowed_file(file.filename):
-        flash(f"Formato de arquivo não suportado. Use: {', '.join(ALLOWED_EXTENSIONS)}", "error")
+        await flash(f"Formato de arquivo não suportado. Use: {', '.join(ALLOWED_EXTENSIONS)}", "error")
         return redirect(url_for("index"))
 
-    user_description = request.form.get("description", "").strip()
+    user_description = form.get("description", "").strip()
 
     # Salva o arquivo com nome único
     original_name = secure_filename(file.filename)
     unique_name = f"{uuid.uuid4().hex}_{original_name}"
     filepath = UPLOAD_FOLDER / unique_name
-    file.save(str(filepath))
+    await file.save(str(filepath), buffer_size=UPLOAD_BUFFER_SIZE)
 
     # Lê a imagem como base64 para exibir no resultado
     ext = filepath.suffix.lower().lstrip(".")
     mime_map = {"jpg": "image/jpeg", "jpeg": "image/jpeg", "png": "image/png",
                 "webp": "image/webp", "gif": "image/gif"}
     image_mime = mime_map.get(ext, "image/jpeg")
-    with open(str(filepath), "rb") as f:
-        image_b64 = base64.b64encode(f.read()).decode("utf-8")
+    image_b64 = await asyncio.to_thread(read_image_b64, filepath)
 
     try:
-        result = analyze_exam(
+        result = await analyze_exam_async(
             exam_image_path=str(filepath),
             api_key=api_key,
             user_description=user_description,
             model_name=get_model_name(),
+            exam_filename=original_name,
         )
 
-        return render_template(
+        return await render_template(
             "result.html",
             analysis=result["analysis"],
             exam_type=result["exam_type"].replace("_", " ").title(),
@@ -108,11 +141,11 @@ def analyze():
         print(f"[ERRO ANÁLISE] {type(e).__name__}: {error_msg}", file=sys.stderr)
         error_lower = error_msg.lower()
         if "api key not valid" in error_lower or "invalid api key" in error_lower or "api_key_invalid" in error_lower:
-            flash("Erro de autenticação: GEMINI_API_KEY inválida. Verifique a chave no painel do Vercel.", "error")
+            await flash("Erro de autenticação: GEMINI_API_KEY inválida. Verifique a chave no painel do Vercel.", "error")
         elif "quota" in error_lower or "rate limit" in error_lower or "resource_exhausted" in error_lower:
-            flash("Cota da API excedida. Tente novamente mais tarde.", "error")
+            await flash("Cota da API excedida. Tente novamente mais tarde.", "error")
         else:
-            flash(f"Erro durante a análise: {error_msg}", "error")
+            await flash(f"Erro durante a análise: {error_msg}", "error")
         return redirect(url_for("index"))
 
     finally:
@@ -124,48 +157,51 @@ def analyze():
 
 
 @app.route("/trial")
-def trial():
+async def trial():
     """Página de teste gratuito para embed via iframe."""
-    return render_template("trial.html")
+    return await render_template("trial.html")
 
 
 @app.route("/trial/analyze", methods=["POST"])
-def trial_analyze():
+async def trial_analyze():
     """Endpoint para análise no modo de teste gratuito (retorna JSON)."""
     api_key = get_api_key()
     if not api_key:
         return jsonify({"error": "Serviço temporariamente indisponível. Tente novamente mais tarde."}), 503
 
-    if "exam_image" not in request.files:
+    files = await request.files
+    form = await request.form
+
+    if "exam_image" not in files:
         return jsonify({"error": "Nenhuma imagem enviada."}), 400
 
-    file = request.files["exam_image"]
+    file = files["exam_image"]
     if file.filename == "":
         return jsonify({"error": "Nenhum arquivo selecionado."}), 400
 
     if not allowed_file(file.filename):
         return jsonify({"error": f"Formato não suportado. Use: {', '.join(ALLOWED_EXTENSIONS)}"}), 400
 
-    user_description = request.form.get("description", "").strip()
+    user_description = form.get("description", "").strip()
 
     original_name = secure_filename(file.filename)
     unique_name = f"{uuid.uuid4().hex}_{original_name}"
     filepath = UPLOAD_FOLDER / unique_name
-    file.save(str(filepath))
+    await file.save(str(filepath), buffer_size=UPLOAD_BUFFER_SIZE)
 
     ext = filepath.suffix.lower().lstrip(".")
     mime_map = {"jpg": "image/jpeg", "jpeg": "image/jpeg", "png": "image/png",
                 "webp": "image/webp", "gif": "image/gif"}
     image_mime = mime_map.get(ext, "image/jpeg")
-    with open(str(filepath), "rb") as f:
-        image_b64 = base64.b64encode(f.read()).decode("utf-8")
+    image_b64 = await asyncio.to_thread(read_image_b64, filepath)
 
     try:
-        result = analyze_exam(
+        result = await analyze_exam_async(
             exam_image_path=str(filepath),
             api_key=api_key,
             user_description=user_description,
             model_name=get_model_name(),
+            exam_filename=original_name,
         )
         return jsonify({
             "analysis": result["analysis"],
@@ -194,32 +230,36 @@ def trial_analyze():
 
 
 @app.route("/api/analyze", methods=["POST"])
-def api_analyze():
+async def api_analyze():
     """Endpoint REST para integração programática."""
     api_key = request.headers.get("X-API-Key") or get_api_key()
     if not api_key:
         return jsonify({"error": "API key não fornecida"}), 401
 
-    if "exam_image" not in request.files:
+    files = await request.files
+    form = await request.form
+
+    if "exam_image" not in files:
         return jsonify({"error": "Nenhuma imagem enviada"}), 400
 
-    file = request.files["exam_image"]
+    file = files["exam_image"]
     if not allowed_file(file.filename):
         return jsonify({"error": "Formato de arquivo não suportado"}), 400
 
-    user_description = request.form.get("description", "")
+    user_description = form.get("description", "")
 
     original_name = secure_filename(file.filename)
     unique_name = f"{uuid.uuid4().hex}_{original_name}"
     filepath = UPLOAD_FOLDER / unique_name
-    file.save(str(filepath))
+    await file.save(str(filepath), buffer_size=UPLOAD_BUFFER_SIZE)
 
     try:
-        result = analyze_exam(
+        result = await analyze_exam_async(
             exam_image_path=str(filepath),
             api_key=api_key,
             user_description=user_description,
             model_name=get_model_name(),
+            exam_filename=original_name,
         )
         return jsonify(result), 200
 
@@ -233,7 +273,97 @@ def api_analyze():
             pass
 
 
+@app.route("/api/analyze_raw", methods=["POST"])
+async def api_analyze_raw():
+    """
+    Endpoint REST com upload do corpo bruto (sem multipart) — preferido para clientes programáticos.
+    Nome do arquivo no header X-Filename; descrição opcional na query string (?description=...).
+    """
+    api_key = request.headers.get("X-API-Key") or get_api_key()
+    if not api_key:
+        return jsonify({"error": "API key não fornecida"}), 401
+
+    filename = request.headers.get("X-Filename", "")
+    if not allowed_file(filename):
+        return jsonify({"error": "Formato de arquivo não suportado"}), 400
+
+    user_description = request.args.get("description", "")
+
+    original_name = secure_filename(filename)
+    unique_name = f"{uuid.uuid4().hex}_{original_name}"
+    filepath = UPLOAD_FOLDER / unique_name
+
+    try:
+        # Grava o corpo em disco conforme chega, sem passar pelo parser multipart.
+        # os.write direto no descritor: cada chunk do servidor ASGI vai para o kernel
+        # sem cópia extra pelo buffer de um objeto arquivo.
+        fd = os.open(str(filepath), os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        try:
+            async for chunk in request.body:
+                view = memoryview(chunk)
+                while view:
+                    view = view[os.write(fd, view):]
+        finally:
+            os.close(fd)
+
+        if filepath.stat().st_size == 0:
+            return jsonify({"error": "Nenhuma imagem enviada"}), 400
+
+        result = await analyze_exam_async(
+            exam_image_path=str(filepath),
+            api_key=api_key,
+            user_description=user_description,
+            model_name=get_model_name(),
+            exam_filename=original_name,
+        )
+        return jsonify(result), 200
+
+    except RequestEntityTooLarge:
+        return jsonify({"error": "Arquivo excede o limite de 20MB", "success": False}), 413
+
+    except Exception as e:
+        return jsonify({"error": str(e), "success": False}), 500
+
+    finally:
+        try:
+            filepath.unlink()
+        except Exception:
+            pass
+
+
+def run_batch(batch_dir: str) -> None:
+    """Analisa todas as imagens de um diretório via Gemini Batch API e imprime o JSON."""
+    from core.analyzer_batch import analyze_exams_batch
+
+    api_key = get_api_key()
+    if not api_key:
+        sys.exit("Erro: GEMINI_API_KEY não configurada.")
+
+    image_paths = sorted(
+        str(p) for p in Path(batch_dir).iterdir()
+        if p.is_file() and allowed_file(p.name)
+    )
+    if not image_paths:
+        sys.exit(f"Nenhuma imagem suportada em {batch_dir}")
+
+    # Logs de progresso (batch, atlas, upload do PDF) vão para stderr: stdout fica só com o JSON
+    with contextlib.redirect_stdout(sys.stderr):
+        results = analyze_exams_batch(image_paths, api_key=api_key, model_name=get_model_name())
+    print(json.dumps(results, ensure_ascii=False, indent=2))
+
+
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Analisador de exames médicos com IA (Gemini)")
+    parser.add_argument("--batch-dir", help="Analisa offline todas as imagens do diretório via Gemini Batch API")
+    args = parser.parse_args()
+
+    if args.batch_dir:
+        run_batch(args.batch_dir)
+        sys.exit(0)
+
+    import uvicorn
+
     port = int(os.environ.get("PORT", 5000))
     debug = os.environ.get("FLASK_DEBUG", "false").lower() == "true"
-    app.run(host="0.0.0.0", port=port, debug=debug)
+    # Um único worker ASGI: as chamadas ao Gemini (I/O) se sobrepõem no mesmo event loop
+    uvicorn.run(app, host="0.0.0.0", port=port, workers=1, log_level="debug" if debug else "info")
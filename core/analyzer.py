@@ -4,29 +4,111 @@ Compara o exame enviado com atlas em PDF e imagens de referência normais.
 
 PDFs são enviados via Gemini File API (upload na primeira chamada, URI cacheado
 em memória por 47h para não re-enviar o arquivo a cada análise).
+
+Resultados são cacheados pelo hash do conteúdo do exame: reenviar a mesma imagem com o
+mesmo contexto devolve o laudo anterior sem nova chamada ao Gemini.
+
+As funções principais são assíncronas (client.aio) para não bloquear o event loop
+do Quart durante a chamada ao Gemini; as versões síncronas são wrappers para uso em CLI.
 """
 
+import asyncio
 import hashlib
-import io
+import mmap
 import os
 import tempfile
 import time
+from collections import OrderedDict
+from functools import lru_cache
 from pathlib import Path
 
 from google import genai
 from google.genai import types
-from PIL import Image
 
+try:
+    from blake3 import blake3
+except ImportError:  # opcional: sem o pacote, usa blake2b do hashlib
+    blake3 = None
+
+from core.imaging import prepare_image, run_in_image_executor
 from core.reference_images import (
     detect_exam_type,
-    get_reference_images_as_bytes,
+    get_reference_images_as_bytes_async,
     get_reference_pdfs,
 )
 
-# Cache in-memory: {md5_hash: {"uri": str, "mime": str, "expires_at": float}}
+# Cache in-memory: {hash_do_pdf: {"uri": str, "mime": str, "expires_at": float}}
 # Persiste enquanto o container Vercel estiver ativo (evita re-upload a cada request)
 _pdf_uri_cache: dict = {}
 
+# Cache in-memory (LRU): {"<hash>|<exam_type>|<descrição>|<modelo>": resultado}
+_ANALYSIS_CACHE_MAX_ENTRIES = 128
+_analysis_cache: OrderedDict[str, dict] = OrderedDict()
+
+
+@lru_cache(maxsize=8)
+def _get_client(api_key: str) -> genai.Client:
+    """
+    Reutiliza o client por chave de API entre requisições (conexões, auth e transporte
+    persistem). lru_cache é thread-safe; o mesmo client atende o caminho síncrono e o .aio.
+    """
+    return genai.Client(api_key=api_key)
+
+
+def _content_digest(data: bytes) -> str:
+    """
+    Hash de conteúdo (32 hex) para chaves de cache. BLAKE3 usa SIMD e é várias vezes
+    mais rápido que SHA-256/MD5 em arquivos de dezenas de MB; não é usado para segurança.
+    """
+    if blake3 is not None:
+        return blake3(data).hexdigest(16)
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+def _analysis_cache_enabled() -> bool:
+    return os.environ.get("DISABLE_ANALYSIS_CACHE", "false").lower() != "true"
+
+
+def _file_digest(path: str) -> str:
+    """Hash do arquivo original lido por mmap (sem decodificar nem copiar para o heap)."""
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return _content_digest(b"")
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return _content_digest(mm)
+
+
+def _analysis_cache_key(
+    content_digest: str, exam_type: str, user_description: str, model_name: str, api_key: str,
+) -> str:
+    """
+    Chave do cache de análises. content_digest é o hash do upload original (antes de
+    prepare_image), então um acerto não paga a decodificação/redução da imagem.
+    Inclui um hash da API key: um laudo só é reutilizado para a mesma chave que o gerou.
+    """
+    key_digest = hashlib.blake2b(api_key.encode(), digest_size=8).hexdigest()
+    return f"{content_digest}|{key_digest}|{exam_type}|{user_description}|{model_name}"
+
+
+def _get_cached_analysis(cache_key: str) -> dict | None:
+    if not _analysis_cache_enabled():
+        return None
+    cached = _analysis_cache.get(cache_key)
+    if cached is None:
+        return None
+    _analysis_cache.move_to_end(cache_key)
+    print(f"[Análise cache] Reutilizando resultado: {cache_key[:32]}...")
+    return dict(cached)
+
+
+def _store_analysis(cache_key: str, result: dict) -> None:
+    if not _analysis_cache_enabled():
+        return
+    _analysis_cache[cache_key] = dict(result)
+    _analysis_cache.move_to_end(cache_key)
+    while len(_analysis_cache) > _ANALYSIS_CACHE_MAX_ENTRIES:
+        _analysis_cache.popitem(last=False)
+
 
 def _get_or_upload_pdf(client: genai.Client, pdf_bytes: bytes) -> tuple[str, str] | None:
     """
@@ -34,7 +116,7 @@ def _get_or_upload_pdf(client: genai.Client, pdf_bytes: bytes) -> tuple[str, str
     Retorna (uri, mime_type) ou None se o upload falhar.
     O arquivo expira em 48h; o cache é invalidado após 47h.
     """
-    pdf_hash = hashlib.md5(pdf_bytes).hexdigest()
+    pdf_hash = _content_digest(pdf_bytes)
 
     cached = _pdf_uri_cache.get(pdf_hash)
     if cached and cached["expires_at"] > time.time():
@@ -72,6 +154,19 @@ def _get_or_upload_pdf(client: genai.Client, pdf_bytes: bytes) -> tuple[str, str
                 pass
 
 
+def _load_exam_image(exam_image_path: str) -> tuple[bytes, str]:
+    """
+    Lê e prepara a imagem do exame a partir de um mmap do arquivo, sem copiá-lo
+    inteiro para o heap antes do PIL: o conteúdo só vira bytes uma vez (original
+    ou já reduzido/convertido).
+    """
+    with open(exam_image_path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return prepare_image(b"")
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return prepare_image(mm)
+
+
 def build_analysis_prompt(exam_type: str) -> str:
     """Constrói o prompt especializado para análise ortopédica."""
     region_map = {
@@ -158,7 +253,7 @@ Three Health AI Assistant
 """
 
 
-def _build_content_parts(
+def _iter_content_parts(
     client: genai.Client,
     exam_image_bytes: bytes,
     mime_type: str,
@@ -166,60 +261,104 @@ def _build_content_parts(
     user_description: str,
     reference_pdfs: list,
     reference_images: list,
-) -> tuple[list, int]:
-    """
-    Monta a lista de parts para envio ao Gemini.
-    Retorna (content_parts, total_references_used).
-    """
-    parts = []
-    refs_used = 0
-
+):
+    """Gera, em ordem, os parts enviados ao Gemini."""
     # 1. Atlas em PDF via File API (ou inline como fallback)
     if reference_pdfs:
-        parts.append(types.Part.from_text(
+        yield types.Part.from_text(
             text="**ATLAS DE REFERÊNCIA ANATÔMICA (use como base de conhecimento):**"
-        ))
+        )
         for pdf_bytes, _ in reference_pdfs:
             result = _get_or_upload_pdf(client, pdf_bytes)
             if result:
                 uri, mime = result
-                parts.append(types.Part.from_uri(uri=uri, mime_type=mime))
+                yield types.Part.from_uri(uri=uri, mime_type=mime)
             else:
                 # Fallback inline se File API falhar (somente se < 20MB)
-                parts.append(types.Part.from_bytes(data=pdf_bytes, mime_type="application/pdf"))
-            refs_used += 1
+                yield types.Part.from_bytes(data=pdf_bytes, mime_type="application/pdf")
 
     # 2. Imagens de referência de exame normal
     if reference_images:
-        parts.append(types.Part.from_text(
+        yield types.Part.from_text(
             text="**IMAGENS DE REFERÊNCIA NORMAL (padrão visual de comparação):**"
-        ))
+        )
         for i, (ref_bytes, ref_mime) in enumerate(reference_images):
-            parts.append(types.Part.from_text(text=f"Referência {i + 1} — Anatomia normal:"))
-            parts.append(types.Part.from_bytes(data=ref_bytes, mime_type=ref_mime))
-            refs_used += 1
+            yield types.Part.from_text(text=f"Referência {i + 1} — Anatomia normal:")
+            yield types.Part.from_bytes(data=ref_bytes, mime_type=ref_mime)
 
     # 3. Exame do paciente
-    parts.append(types.Part.from_text(text="\n**EXAME DO PACIENTE (imagem para análise):**"))
-    parts.append(types.Part.from_bytes(data=exam_image_bytes, mime_type=mime_type))
+    yield types.Part.from_text(text="\n**EXAME DO PACIENTE (imagem para análise):**")
+    yield types.Part.from_bytes(data=exam_image_bytes, mime_type=mime_type)
 
     # 4. Contexto clínico
     if user_description:
-        parts.append(types.Part.from_text(
+        yield types.Part.from_text(
             text=f"\n**Contexto clínico fornecido:** {user_description}"
-        ))
+        )
 
     # 5. Prompt de análise
-    parts.append(types.Part.from_text(text=build_analysis_prompt(exam_type)))
+    yield types.Part.from_text(text=build_analysis_prompt(exam_type))
 
-    return parts, refs_used
 
+def _build_content_parts(
+    client: genai.Client,
+    exam_image_bytes: bytes,
+    mime_type: str,
+    exam_type: str,
+    user_description: str,
+    reference_pdfs: list,
+    reference_images: list,
+) -> tuple[list, int]:
+    """
+    Monta a lista de parts para envio ao Gemini.
+    Retorna (content_parts, total_references_used).
+    """
+    content_parts = list(_iter_content_parts(
+        client, exam_image_bytes, mime_type, exam_type, user_description,
+        reference_pdfs, reference_images,
+    ))
+    return content_parts, len(reference_pdfs) + len(reference_images)
 
-def analyze_exam(
+
+async def _run_analysis(
+    client: genai.Client,
+    cache_key: str,
+    exam_image_bytes: bytes,
+    mime_type: str,
+    exam_type: str,
+    user_description: str,
+    model_name: str,
+) -> dict:
+    """Corpo comum das análises (após um miss no cache): referências, parts e chamada ao Gemini."""
+    # Leitura do PDF e upload para a File API rodam fora do event loop
+    reference_pdfs = await asyncio.to_thread(get_reference_pdfs)
+    reference_images = await get_reference_images_as_bytes_async(exam_type)
+
+    content_parts, refs_used = await asyncio.to_thread(
+        _build_content_parts,
+        client, exam_image_bytes, mime_type, exam_type, user_description,
+        reference_pdfs, reference_images,
+    )
+
+    response = await client.aio.models.generate_content(model=model_name, contents=content_parts)
+
+    result = {
+        "success": True,
+        "exam_type": exam_type,
+        "analysis": response.text,
+        "references_used": refs_used,
+        "model_used": model_name,
+    }
+    _store_analysis(cache_key, result)
+    return result
+
+
+async def analyze_exam_async(
     exam_image_path: str,
     api_key: str,
     user_description: str = "",
     model_name: str = "gemini-2.5-flash",
+    exam_filename: str | None = None,
 ) -> dict:
     """
     Analisa um exame médico comparando com atlas em PDF e imagens de referência normais.
@@ -229,50 +368,32 @@ def analyze_exam(
         api_key: Chave da API do Gemini
         user_description: Descrição adicional fornecida pelo usuário
         model_name: Modelo Gemini a utilizar
+        exam_filename: Nome original do arquivo, usado para detectar a região
+            (padrão: nome do arquivo em exam_image_path)
 
     Returns:
         Dicionário com resultado da análise e metadados
     """
-    client = genai.Client(api_key=api_key)
-
-    filename = Path(exam_image_path).name
+    filename = exam_filename or Path(exam_image_path).name
     exam_type = detect_exam_type(filename, user_description)
 
-    with open(exam_image_path, "rb") as f:
-        exam_image_bytes = f.read()
-
-    try:
-        img = Image.open(io.BytesIO(exam_image_bytes))
-        img_format = img.format or "JPEG"
-        if img_format.upper() not in ["JPEG", "PNG", "WEBP", "GIF"]:
-            buffer = io.BytesIO()
-            img.convert("RGB").save(buffer, format="JPEG")
-            exam_image_bytes = buffer.getvalue()
-            img_format = "JPEG"
-        mime_type = f"image/{img_format.lower()}"
-    except Exception:
-        mime_type = "image/jpeg"
-
-    reference_pdfs = get_reference_pdfs()
-    reference_images = get_reference_images_as_bytes(exam_type)
-
-    content_parts, refs_used = _build_content_parts(
-        client, exam_image_bytes, mime_type, exam_type, user_description,
-        reference_pdfs, reference_images,
-    )
+    # Cache consultado com o hash do arquivo original, antes de decodificar a imagem
+    digest = await asyncio.to_thread(_file_digest, exam_image_path)
+    cache_key = _analysis_cache_key(digest, exam_type, user_description, model_name, api_key)
+    cached = _get_cached_analysis(cache_key)
+    if cached is not None:
+        return cached
 
-    response = client.models.generate_content(model=model_name, contents=content_parts)
+    # Decodificação/redução com PIL roda no pool de imagem, fora do event loop
+    exam_image_bytes, mime_type = await run_in_image_executor(_load_exam_image, exam_image_path)
 
-    return {
-        "success": True,
-        "exam_type": exam_type,
-        "analysis": response.text,
-        "references_used": refs_used,
-        "model_used": model_name,
-    }
+    return await _run_analysis(
+        _get_client(api_key), cache_key, exam_image_bytes, mime_type,
+        exam_type, user_description, model_name,
+    )
 
 
-def analyze_exam_from_bytes(
+async def analyze_exam_from_bytes_async(
     exam_image_bytes: bytes,
     exam_filename: str,
     api_key: str,
@@ -283,36 +404,43 @@ def analyze_exam_from_bytes(
     Analisa um exame médico diretamente dos bytes da imagem.
     Versão alternativa que não requer salvar o arquivo primeiro.
     """
-    client = genai.Client(api_key=api_key)
-
     exam_type = detect_exam_type(exam_filename, user_description)
 
-    try:
-        img = Image.open(io.BytesIO(exam_image_bytes))
-        img_format = img.format or "JPEG"
-        if img_format.upper() not in ["JPEG", "PNG", "WEBP"]:
-            buffer = io.BytesIO()
-            img.convert("RGB").save(buffer, format="JPEG")
-            exam_image_bytes = buffer.getvalue()
-            img_format = "JPEG"
-        mime_type = f"image/{img_format.lower()}"
-    except Exception:
-        mime_type = "image/jpeg"
-
-    reference_pdfs = get_reference_pdfs()
-    reference_images = get_reference_images_as_bytes(exam_type)
-
-    content_parts, refs_used = _build_content_parts(
-        client, exam_image_bytes, mime_type, exam_type, user_description,
-        reference_pdfs, reference_images,
+    digest = await asyncio.to_thread(_content_digest, exam_image_bytes)
+    cache_key = _analysis_cache_key(digest, exam_type, user_description, model_name, api_key)
+    cached = _get_cached_analysis(cache_key)
+    if cached is not None:
+        return cached
+
+    exam_image_bytes, mime_type = await run_in_image_executor(prepare_image, exam_image_bytes)
+
+    return await _run_analysis(
+        _get_client(api_key), cache_key, exam_image_bytes, mime_type,
+        exam_type, user_description, model_name,
     )
 
-    response = client.models.generate_content(model=model_name, contents=content_parts)
 
-    return {
-        "success": True,
-        "exam_type": exam_type,
-        "analysis": response.text,
-        "references_used": refs_used,
-        "model_used": model_name,
-    }
+def analyze_exam(
+    exam_image_path: str,
+    api_key: str,
+    user_description: str = "",
+    model_name: str = "gemini-2.5-flash",
+    exam_filename: str | None = None,
+) -> dict:
+    """Versão síncrona de analyze_exam_async (uso em scripts/CLI)."""
+    return asyncio.run(analyze_exam_async(
+        exam_image_path, api_key, user_description, model_name, exam_filename,
+    ))
+
+
+def analyze_exam_from_bytes(
+    exam_image_bytes: bytes,
+    exam_filename: str,
+    api_key: str,
+    user_description: str = "",
+    model_name: str = "gemini-2.5-flash",
+) -> dict:
+    """Versão síncrona de analyze_exam_from_bytes_async (uso em scripts/CLI)."""
+    return asyncio.run(analyze_exam_from_bytes_async(
+        exam_image_bytes, exam_filename, api_key, user_description, model_name,
+    ))
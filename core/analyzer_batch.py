@@ -0,0 +1,159 @@
+"""
+Análise em lote via Gemini Batch API, para reprocessamento offline de vários exames
+(ex.: rodar um prompt atualizado sobre um diretório de exames anteriores).
+
+Monta um JSONL com uma requisição por exame (mesmos parts da análise online), envia
+pela File API, cria o batch job e aguarda o resultado. O Batch API custa ~50% menos
+que chamadas individuais, mas pode levar de minutos a horas para concluir.
+"""
+
+import json
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from google.genai import types
+
+from core.analyzer import _build_content_parts, _get_client
+from core.imaging import prepare_image
+from core.reference_images import (
+    detect_exam_type,
+    get_reference_images_as_bytes,
+    get_reference_pdfs,
+)
+
+_POLL_INTERVAL_SECONDS = 30
+
+_FINAL_STATES = {
+    "JOB_STATE_SUCCEEDED",
+    "JOB_STATE_PARTIALLY_SUCCEEDED",
+    "JOB_STATE_FAILED",
+    "JOB_STATE_CANCELLED",
+    "JOB_STATE_EXPIRED",
+}
+
+
+def _build_jsonl(client, image_paths: list[str]) -> tuple[list[str], dict]:
+    """
+    Monta as linhas do JSONL de requisições.
+    Retorna (linhas, {key: metadados do exame}).
+    """
+    reference_pdfs = get_reference_pdfs()
+
+    lines = []
+    requests_meta = {}
+    for i, image_path in enumerate(image_paths):
+        exam_type = detect_exam_type(Path(image_path).name)
+        exam_image_bytes, mime_type = prepare_image(Path(image_path).read_bytes())
+        reference_images = get_reference_images_as_bytes(exam_type)
+
+        content_parts, refs_used = _build_content_parts(
+            client, exam_image_bytes, mime_type, exam_type, "",
+            reference_pdfs, reference_images,
+        )
+        contents = types.Content(role="user", parts=content_parts)
+
+        key = f"exam-{i}"
+        lines.append(json.dumps({
+            "key": key,
+            "request": {"contents": [contents.model_dump(mode="json", exclude_none=True)]},
+        }))
+        requests_meta[key] = {
+            "exam_path": image_path,
+            "exam_type": exam_type,
+            "references_used": refs_used,
+        }
+
+    return lines, requests_meta
+
+
+def analyze_exams_batch(
+    image_paths: list[str],
+    api_key: str,
+    model_name: str = "gemini-2.5-flash",
+) -> list[dict]:
+    """
+    Analisa vários exames em um único batch job do Gemini.
+
+    Args:
+        image_paths: Caminhos das imagens dos exames
+        api_key: Chave da API do Gemini
+        model_name: Modelo Gemini a utilizar
+
+    Returns:
+        Lista de resultados na mesma ordem de image_paths (mesmo formato de analyze_exam,
+        com "exam_path"; em caso de erro, "success": False e "error")
+    """
+    client = _get_client(api_key)
+    lines, requests_meta = _build_jsonl(client, image_paths)
+
+    tmp_path = None
+    try:
+        with tempfile.NamedTemporaryFile(
+            "w", suffix=".jsonl", delete=False, encoding="utf-8",
+        ) as tmp:
+            tmp.write("\n".join(lines))
+            tmp_path = tmp.name
+
+        print(f"[Batch] Enviando {len(lines)} requisições para a File API...", file=sys.stderr)
+        uploaded = client.files.upload(
+            file=tmp_path,
+            config=types.UploadFileConfig(display_name="analise-exame-batch", mime_type="jsonl"),
+        )
+    finally:
+        if tmp_path:
+            try:
+                os.unlink(tmp_path)
+            except Exception:
+                pass
+
+    job = client.batches.create(
+        model=model_name,
+        src=uploaded.name,
+        config=types.CreateBatchJobConfig(display_name="analise-exame-batch"),
+    )
+    print(f"[Batch] Job criado: {job.name}", file=sys.stderr)
+
+    while job.state.name not in _FINAL_STATES:
+        time.sleep(_POLL_INTERVAL_SECONDS)
+        job = client.batches.get(name=job.name)
+        print(f"[Batch] Estado: {job.state.name}", file=sys.stderr)
+
+    if job.state.name not in ("JOB_STATE_SUCCEEDED", "JOB_STATE_PARTIALLY_SUCCEEDED"):
+        raise RuntimeError(f"Batch job {job.name} terminou com estado {job.state.name}: {job.error}")
+
+    output = client.files.download(file=job.dest.file_name)
+
+    results_by_key = {}
+    for line in output.decode("utf-8").splitlines():
+        if not line.strip():
+            continue
+        item = json.loads(line)
+        meta = requests_meta[item["key"]]
+        if "response" in item:
+            response = types.GenerateContentResponse.model_validate(item["response"])
+            results_by_key[item["key"]] = {
+                "success": True,
+                "exam_path": meta["exam_path"],
+                "exam_type": meta["exam_type"],
+                "analysis": response.text,
+                "references_used": meta["references_used"],
+                "model_used": model_name,
+            }
+        else:
+            results_by_key[item["key"]] = {
+                "success": False,
+                "exam_path": meta["exam_path"],
+                "error": str(item.get("error", "sem resposta")),
+            }
+
+    return [
+        results_by_key.get(key, {
+            "success": False,
+            "exam_path": meta["exam_path"],
+            "error": "sem resposta",
+        })
+        for key, meta in requests_meta.items()
+    ]
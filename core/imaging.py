@@ -0,0 +1,118 @@
+"""
+Utilitários de imagem compartilhados pelo analisador e pelas imagens de referência.
+
+Detecta o formato pelos magic bytes (sem decodificar) e reduz imagens muito grandes
+antes do envio ao Gemini — menos banda de upload e menos tokens de visão por análise.
+"""
+
+import asyncio
+import io
+import mmap
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import PIL
+from PIL import Image, ImageOps, features
+
+DEFAULT_MAX_SIDE = 1536  # px no lado maior — suficiente para leitura dos achados
+
+# Pool dedicado ao trabalho de CPU com PIL (um thread por núcleo). O executor padrão
+# do event loop fica livre para I/O bloqueante (leitura de PDF, upload na File API).
+_image_executor = ThreadPoolExecutor(max_workers=os.cpu_count() or 1, thread_name_prefix="imaging")
+
+
+async def run_in_image_executor(func, *args):
+    """Executa func(*args) no pool de imagem sem bloquear o event loop."""
+    return await asyncio.get_running_loop().run_in_executor(_image_executor, func, *args)
+
+
+def describe_pil_build() -> str:
+    """
+    Descreve o build do PIL em uso. Pillow-SIMD (versões ".postN") tem redimensionamento
+    vetorizado (AVX2) e, com libjpeg-turbo, decode/encode JPEG bem mais rápidos.
+    """
+    flavor = "Pillow-SIMD" if ".post" in PIL.__version__ else "Pillow"
+    turbo = "sim" if features.check_feature("libjpeg_turbo") else "não"
+    return f"{flavor} {PIL.__version__} (libjpeg-turbo: {turbo})"
+
+
+def get_max_side() -> int:
+    """Lado maior máximo (px) das imagens enviadas ao Gemini. Configurável via IMAGE_MAX_SIDE."""
+    return int(os.environ.get("IMAGE_MAX_SIDE", DEFAULT_MAX_SIDE))
+
+
+def sniff_mime(data: bytes) -> str | None:
+    """Identifica JPEG/PNG/WEBP/GIF pelos magic bytes, sem decodificar a imagem."""
+    if data[:3] == b"\xff\xd8\xff":
+        return "image/jpeg"
+    if data[:8] == b"\x89PNG\r\n\x1a\n":
+        return "image/png"
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp"
+    if data[:6] in (b"GIF87a", b"GIF89a"):
+        return "image/gif"
+    return None
+
+
+def to_jpeg_mode(img: Image.Image) -> Image.Image:
+    """
+    Converte a imagem para um modo que o JPEG representa sem perder conteúdo visível:
+    - 16 bits / inteiro / float (ex.: PNG de radiologia): escala min–max para 8 bits "L"
+      (convert direto cortaria tudo acima de 255 e a imagem sairia branca);
+    - com transparência (RGBA, LA, P com transparência): compõe sobre fundo branco;
+    - demais modos não suportados: RGB.
+    """
+    if img.mode in ("I;16", "I;16L", "I;16B", "I;16N", "I", "F"):
+        if img.mode.startswith("I;16"):
+            img = img.convert("I")
+        low, high = img.getextrema()
+        scale = 255 / (high - low) if high > low else 0
+        return img.point(lambda v: v * scale - low * scale).convert("L")
+
+    if img.mode in ("RGBA", "LA", "PA") or (img.mode == "P" and "transparency" in img.info):
+        img = img.convert("RGBA")
+        background = Image.new("RGB", img.size, "white")
+        background.paste(img, mask=img.getchannel("A"))
+        return background
+
+    if img.mode not in ("RGB", "L"):
+        return img.convert("RGB")
+    return img
+
+
+def encode_jpeg(img: Image.Image, max_side: int, quality: int = 90, **save_options) -> bytes:
+    """
+    Aplica a orientação EXIF, reduz para caber em max_side (se necessário) e codifica em JPEG.
+    save_options vão direto para Image.save (ex.: optimize=True, progressive=True).
+    """
+    # O re-encode descarta o EXIF: sem girar os pixels, fotos de celular chegariam deitadas
+    img = ImageOps.exif_transpose(img)
+    img = to_jpeg_mode(img)
+    img.thumbnail((max_side, max_side), Image.LANCZOS)
+    buffer = io.BytesIO()
+    img.save(buffer, format="JPEG", quality=quality, **save_options)
+    return buffer.getvalue()
+
+
+def prepare_image(data: bytes | mmap.mmap) -> tuple[bytes, str]:
+    """
+    Retorna (bytes, mime_type) prontos para envio ao Gemini.
+
+    - Formato aceito e dentro do limite: bytes originais, sem decodificar pixels
+      (Image.open só lê o cabeçalho para obter as dimensões).
+    - Maior que o limite ou formato não aceito: reduzido/convertido para JPEG.
+    - Não reconhecido pelo PIL (ex.: DICOM): bytes originais como image/jpeg.
+
+    Aceita também um mmap do arquivo: o PIL lê direto do mapeamento e o conteúdo só é
+    copiado para bytes quando a imagem original vai ser enviada sem alteração.
+    """
+    mime_type = sniff_mime(bytes(data[:16]))
+    max_side = get_max_side()
+
+    try:
+        img = Image.open(data if isinstance(data, mmap.mmap) else io.BytesIO(data))
+        if mime_type and max(img.size) <= max_side:
+            return bytes(data), mime_type
+        return encode_jpeg(img, max_side), "image/jpeg"
+    except Exception:
+        return bytes(data), mime_type or "image/jpeg"
@@ -4,11 +4,23 @@ Gerencia imagens de referência (normais) e atlas em PDF para exames ortopédico
 Ordem de prioridade:
 1. PDFs de atlas em reference_data/docs/          (base de conhecimento global)
 2. Imagens commitadas em reference_data/<tipo>/   (referências por região anatômica)
-3. Download de URLs públicas como fallback
+3. Download de URLs públicas como fallback (em paralelo via aiohttp)
+
+As imagens resolvidas ficam em memória por tipo de exame (são imutáveis e há
+poucos tipos), evitando reler o disco a cada análise.
 """
 
-import requests
+import asyncio
+import hashlib
+import os
+import tempfile
 from pathlib import Path
+from urllib.parse import urlparse
+
+import ahocorasick
+import aiohttp
+
+from core.imaging import prepare_image, run_in_image_executor
 
 _THIS_DIR = Path(__file__).parent
 REFERENCE_DATA_DIR = _THIS_DIR.parent / "reference_data"
@@ -33,6 +45,24 @@ EXAM_TYPE_KEYWORDS = {
                      "epicondilo", "olecrano"],
 }
 
+def _build_keyword_automaton():
+    """
+    Autômato Aho-Corasick com todas as palavras-chave: uma única passada no texto,
+    independente de quantas palavras existam. Valor = (prioridade, região), em que a
+    ordem do dict define a prioridade entre regiões.
+    """
+    automaton = ahocorasick.Automaton()
+    for priority, (exam_type, keywords) in enumerate(EXAM_TYPE_KEYWORDS.items()):
+        for kw in keywords:
+            # Palavra repetida em duas regiões: fica a de maior prioridade (primeira no dict)
+            if not automaton.exists(kw):
+                automaton.add_word(kw, (priority, exam_type))
+    automaton.make_automaton()
+    return automaton
+
+
+_KEYWORD_AUTOMATON = _build_keyword_automaton()
+
 FALLBACK_URLS = {
     "joelho": [
         "https://upload.wikimedia.org/wikipedia/commons/thumb/9/9e/MRI_of_human_knee.jpg/800px-MRI_of_human_knee.jpg",
@@ -48,17 +78,48 @@ FALLBACK_URLS = {
     ],
 }
 
+# Conjunto usado por tipos sem URLs próprias (ver fallback_key_for)
+DEFAULT_FALLBACK_KEY = "joelho"
+
 _IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".webp"}
 _PDF_MAX_BYTES = 20 * 1024 * 1024  # 20 MB
 
+# Cache em disco dos downloads, endereçado pela URL (ver fallback_cache_path)
+_DOWNLOAD_CACHE_DIR = Path("/tmp/reference_data")
+
+_HTTP_HEADERS = {"User-Agent": "EHealthOrtopedia/1.0"}
+_HTTP_TIMEOUT = aiohttp.ClientTimeout(total=15)
+
+# Cache in-memory: {exam_type: ((bytes, mime_type), ...)}
+# Poucos tipos de exame e arquivos imutáveis — não precisa de evicção.
+_reference_images_cache: dict[str, tuple[tuple[bytes, str], ...]] = {}
+
+# Sessão HTTP compartilhada enquanto o app está servindo (mantém o pool de conexões quente).
+# Aberta/fechada pelos hooks before_serving/after_serving do app.
+_http_session: aiohttp.ClientSession | None = None
+
+
+async def open_http_session() -> None:
+    """Cria a sessão aiohttp compartilhada (chamar dentro do event loop do app)."""
+    global _http_session
+    if _http_session is None or _http_session.closed:
+        _http_session = aiohttp.ClientSession(headers=_HTTP_HEADERS, timeout=_HTTP_TIMEOUT)
+
+
+async def close_http_session() -> None:
+    """Fecha a sessão aiohttp compartilhada."""
+    global _http_session
+    if _http_session is not None and not _http_session.closed:
+        await _http_session.close()
+    _http_session = None
+
 
 def detect_exam_type(filename: str, user_description: str = "") -> str:
     """Detecta a região anatômica ortopédica pelo nome do arquivo ou descrição."""
     combined = (filename + " " + user_description).lower()
-    for exam_type, keywords in EXAM_TYPE_KEYWORDS.items():
-        if any(kw in combined for kw in keywords):
-            return exam_type
-    return "geral"
+    # Entre as regiões encontradas vale a primeira do dict
+    best = min((match for _, match in _KEYWORD_AUTOMATON.iter(combined)), default=None)
+    return best[1] if best else "geral"
 
 
 def get_reference_pdfs() -> list[tuple[bytes, str]]:
@@ -109,33 +170,137 @@ def _load_images_from_dir(directory: Path, max_images: int = 2) -> list[tuple[by
     return results
 
 
-def _download_fallback(exam_type: str) -> list[tuple[bytes, str]]:
-    """Baixa imagens de referência da internet como fallback. Cache em /tmp."""
-    key = exam_type if exam_type in FALLBACK_URLS else "joelho"
-    urls = FALLBACK_URLS[key]
-    cache_dir = Path("/tmp/reference_data") / exam_type
-    cache_dir.mkdir(parents=True, exist_ok=True)
+def fallback_key_for(exam_type: str) -> str:
+    """Chave de FALLBACK_URLS usada para o tipo de exame (joelho para tipos sem URLs próprias)."""
+    return exam_type if exam_type in FALLBACK_URLS else DEFAULT_FALLBACK_KEY
 
-    results = []
-    for i, url in enumerate(urls[:2]):
-        cached_path = cache_dir / f"ref_{i}.jpg"
 
-        if cached_path.exists():
-            try:
-                results.append((cached_path.read_bytes(), "image/jpeg"))
-                continue
-            except Exception:
-                pass
+def fallback_cache_path(key: str, url: str) -> Path:
+    """
+    Caminho em cache para a URL: o nome inclui o hash da URL, então trocar uma URL em
+    FALLBACK_URLS invalida o cache sozinho e URLs diferentes nunca colidem.
+    """
+    url_hash = hashlib.sha1(url.encode()).hexdigest()[:16]
+    suffix = Path(urlparse(url).path).suffix.lower() or ".jpg"
+    return _DOWNLOAD_CACHE_DIR / f"{key}_{url_hash}{suffix}"
+
 
+def _write_atomic(path: Path, data: bytes) -> None:
+    """Grava em arquivo temporário no mesmo diretório e renomeia — leitores nunca veem arquivo parcial."""
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except Exception:
         try:
-            resp = requests.get(url, headers={"User-Agent": "EHealthOrtopedia/1.0"}, timeout=15)
-            if resp.status_code == 200:
-                cached_path.write_bytes(resp.content)
-                results.append((resp.content, "image/jpeg"))
-        except Exception as e:
-            print(f"Aviso: não foi possível baixar referência de fallback: {e}")
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
 
-    return results
+
+def _read_cached(path: Path) -> bytes | None:
+    """Lê um download já em cache; None se não existir ou não puder ser lido."""
+    try:
+        return path.read_bytes()
+    except OSError:
+        return None
+
+
+async def _fetch_one(
+    session: aiohttp.ClientSession, url: str, cached_path: Path,
+) -> tuple[bytes, str] | None:
+    """Baixa uma imagem de referência (ou lê do cache em /tmp). Retorna (bytes, mime) ou None."""
+    # Leitura/gravação do cache em disco rodam fora do event loop
+    cached = await asyncio.to_thread(_read_cached, cached_path)
+    if cached is not None:
+        return cached, "image/jpeg"
+
+    try:
+        async with session.get(url, headers=_HTTP_HEADERS, timeout=_HTTP_TIMEOUT) as resp:
+            if resp.status == 200:
+                data = await resp.read()
+            else:
+                return None
+    except Exception as e:
+        print(f"Aviso: não foi possível baixar referência de fallback: {e}")
+        return None
+
+    try:
+        await asyncio.to_thread(_write_atomic, cached_path, data)
+    except Exception as e:
+        print(f"Aviso: não foi possível gravar {cached_path.name} no cache: {e}")
+    return data, "image/jpeg"
+
+
+async def download_fallback_images(
+    key: str, session: aiohttp.ClientSession,
+) -> list[tuple[str, bytes | None]]:
+    """
+    Baixa em paralelo as URLs de FALLBACK_URLS[key] (no máximo 2), com cache em /tmp.
+    Retorna (url, bytes) por URL, com None quando o download falhou.
+    """
+    await asyncio.to_thread(_DOWNLOAD_CACHE_DIR.mkdir, parents=True, exist_ok=True)
+    urls = FALLBACK_URLS[key][:2]
+
+    fetched = await asyncio.gather(
+        *(_fetch_one(session, url, fallback_cache_path(key, url)) for url in urls),
+        return_exceptions=True,
+    )
+    return [
+        (url, result[0] if isinstance(result, tuple) else None)
+        for url, result in zip(urls, fetched)
+    ]
+
+
+async def _download_fallback_async(
+    exam_type: str, session: aiohttp.ClientSession | None = None,
+) -> list[tuple[bytes, str]]:
+    """
+    Baixa imagens de referência da internet como fallback, todas em paralelo. Cache em /tmp.
+    Usa a sessão compartilhada do app quando disponível.
+    """
+    if session is None:
+        session = _http_session
+    if session is None or session.closed:
+        async with aiohttp.ClientSession() as own_session:
+            return await _download_fallback_async(exam_type, own_session)
+
+    fetched = await download_fallback_images(fallback_key_for(exam_type), session)
+    return [(data, "image/jpeg") for _, data in fetched if data is not None]
+
+
+def _download_fallback(exam_type: str) -> list[tuple[bytes, str]]:
+    """Versão síncrona de _download_fallback_async (fora do event loop do app)."""
+    async def _run() -> list[tuple[bytes, str]]:
+        async with aiohttp.ClientSession() as session:
+            return await _download_fallback_async(exam_type, session)
+
+    return asyncio.run(_run())
+
+
+def _load_local_images(exam_type: str) -> list[tuple[bytes, str]]:
+    """Imagens commitadas em reference_data/<exam_type>/, com geral/ como alternativa."""
+    images = _load_images_from_dir(REFERENCE_DATA_DIR / exam_type)
+
+    if not images and exam_type != "geral":
+        images = _load_images_from_dir(REFERENCE_DATA_DIR / "geral")
+
+    return images
+
+
+def _reference_cache_enabled() -> bool:
+    return os.environ.get("DISABLE_REFERENCE_CACHE", "false").lower() != "true"
+
+
+def _finalize(exam_type: str, images: list[tuple[bytes, str]]) -> list[tuple[bytes, str]]:
+    """Reduz imagens grandes (mesmo limite do exame) e guarda o resultado no cache."""
+    images = [prepare_image(data) for data, _ in images]
+    # Resultado vazio (ex.: download falhou) não é cacheado para tentar de novo depois
+    if images and _reference_cache_enabled():
+        _reference_images_cache[exam_type] = tuple(images)
+    return images
 
 
 def get_reference_images_as_bytes(exam_type: str) -> list[tuple[bytes, str]]:
@@ -143,16 +308,52 @@ def get_reference_images_as_bytes(exam_type: str) -> list[tuple[bytes, str]]:
     Retorna imagens de referência como (bytes, mime_type) para envio ao Gemini.
 
     Prioridade:
-    1. Imagens em reference_data/<exam_type>/ no repositório
-    2. Download de URL pública como fallback
+    1. Cache em memória
+    2. Imagens em reference_data/<exam_type>/ no repositório
+    3. Download de URL pública como fallback
     """
-    local_dir = REFERENCE_DATA_DIR / exam_type
-    images = _load_images_from_dir(local_dir)
+    cached = _reference_images_cache.get(exam_type)
+    if cached is not None:
+        return list(cached)
 
-    if not images and exam_type != "geral":
-        images = _load_images_from_dir(REFERENCE_DATA_DIR / "geral")
+    images = _load_local_images(exam_type)
 
     if not images:
         images = _download_fallback(exam_type)
 
-    return images
+    return _finalize(exam_type, images)
+
+
+async def get_reference_images_as_bytes_async(exam_type: str) -> list[tuple[bytes, str]]:
+    """Versão assíncrona de get_reference_images_as_bytes (downloads em paralelo)."""
+    cached = _reference_images_cache.get(exam_type)
+    if cached is not None:
+        return list(cached)
+
+    images = await asyncio.to_thread(_load_local_images, exam_type)
+
+    if not images:
+        images = await _download_fallback_async(exam_type)
+
+    return await run_in_image_executor(_finalize, exam_type, images)
+
+
+async def warm_reference_cache() -> None:
+    """
+    Pré-carrega as referências de todos os tipos de exame (executado no startup do app).
+
+    Vários tipos compartilham o mesmo conjunto de FALLBACK_URLS (joelho), então primeiro
+    aquece um tipo por chave e só depois os demais, que já encontram os downloads no cache
+    em disco em vez de baixar as mesmas URLs em paralelo.
+    """
+    if not _reference_cache_enabled():
+        return
+
+    exam_types = [*EXAM_TYPE_KEYWORDS, "geral"]
+    first_round = [key for key in FALLBACK_URLS if key in exam_types]
+    second_round = [t for t in exam_types if t not in first_round]
+    for batch in (first_round, second_round):
+        await asyncio.gather(
+            *(get_reference_images_as_bytes_async(t) for t in batch),
+            return_exceptions=True,
+        )
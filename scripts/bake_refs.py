@@ -0,0 +1,70 @@
+"""
+Pré-processa as imagens de referência de fallback (FALLBACK_URLS) fora do caminho da
+requisição: baixa cada URL, reduz ao lado maior configurado e grava JPEG progressivo
+otimizado em reference_data/<tipo>/ — pasta que reference_images consulta antes de
+qualquer download. O conjunto padrão (usado por tipos sem URLs próprias) também vai para
+reference_data/geral/, a alternativa de todos os tipos. Assim nenhum usuário espera
+pela Wikimedia após um cold start.
+
+Uso (no build/deploy, ou uma vez localmente antes do commit):
+    python scripts/bake_refs.py
+"""
+
+import asyncio
+import io
+import sys
+from pathlib import Path
+
+import aiohttp
+from PIL import Image
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from core.imaging import encode_jpeg, get_max_side
+from core.reference_images import (
+    DEFAULT_FALLBACK_KEY,
+    FALLBACK_URLS,
+    REFERENCE_DATA_DIR,
+    download_fallback_images,
+    fallback_cache_path,
+)
+
+
+async def _download_all() -> list[tuple[str, str, bytes | None]]:
+    """Baixa todos os conjuntos em paralelo (reaproveitando o cache em /tmp). Retorna (chave, url, bytes)."""
+    async with aiohttp.ClientSession() as session:
+        fetched = await asyncio.gather(
+            *(download_fallback_images(key, session) for key in FALLBACK_URLS)
+        )
+    return [
+        (key, url, data)
+        for key, results in zip(FALLBACK_URLS, fetched)
+        for url, data in results
+    ]
+
+
+def main() -> int:
+    max_side = get_max_side()
+    failures = 0
+
+    for key, url, data in asyncio.run(_download_all()):
+        if data is None:
+            print(f"[bake] Falhou: {url}")
+            failures += 1
+            continue
+
+        baked = encode_jpeg(
+            Image.open(io.BytesIO(data)), max_side, quality=85, optimize=True, progressive=True,
+        )
+        target_dirs = [key, "geral"] if key == DEFAULT_FALLBACK_KEY else [key]
+        for target_dir in target_dirs:
+            out_path = REFERENCE_DATA_DIR / target_dir / fallback_cache_path(key, url).with_suffix(".jpg").name
+            out_path.parent.mkdir(parents=True, exist_ok=True)
+            out_path.write_bytes(baked)
+            print(f"[bake] {out_path.relative_to(REFERENCE_DATA_DIR.parent)} ({len(baked) // 1024} KB)")
+
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())